@@ -20,17 +20,31 @@ sequence of grids constituting a multiblock grid.
 """
 
 from enum import Enum
+import hashlib
 import itertools
+import os
+import tempfile
+import zipfile
 
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib import rc
-rc('text', usetex=True)
+from matplotlib.collections import PolyCollection
+from matplotlib import rc_context
 
 from sbpy import operators
 
 
 _SIDES = ['s', 'e', 'n', 'w']
+_BOUNDARY_SLICE = { 's': (slice(None), 0),
+                    'e': (-1, slice(None)),
+                    'n': (slice(None), -1),
+                    'w': (0, slice(None)) }
+_FLIPPED_SIDE_PAIRS = { ('s','e'), ('s','s'),
+                        ('e','s'), ('e','e'),
+                        ('n','w'), ('n','n'),
+                        ('w','n'), ('w','w') }
+_IS_FLIPPED = np.array([ [ (side1,side2) in _FLIPPED_SIDE_PAIRS for
+                           side2 in _SIDES ] for side1 in _SIDES ])
 
 
 def collocate_corners(blocks, tol=1e-15):
@@ -46,33 +60,13 @@ def collocate_corners(blocks, tol=1e-15):
 
 def get_boundary(X,Y,side):
     """ Returns the boundary of a block. """
-
-    assert(side in {'w','e','s','n'})
-
-    if side == 'w':
-        return X[0,:], Y[0,:]
-    elif side == 'e':
-        return X[-1,:], Y[-1,:]
-    elif side == 's':
-        return X[:,0], Y[:,0]
-    elif side == 'n':
-        return X[:,-1], Y[:,-1]
+    bd_slice = _BOUNDARY_SLICE[side]
+    return X[bd_slice], Y[bd_slice]
 
 
 def get_function_boundary(F,side):
     """ Returns the boundary of a grid function. """
-
-    assert(side in {'w','e','s','n'})
-
-    if side == 'w':
-        return F[0,:]
-    elif side == 'e':
-        return F[-1,:]
-    elif side == 's':
-        return F[:,0]
-    elif side == 'n':
-        return F[:,-1]
-
+    return F[_BOUNDARY_SLICE[side]]
 
 
 def get_corners(X,Y):
@@ -110,14 +104,90 @@ def multiblock_to_array(grid, F):
     return np.array(F).flatten()
 
 
+def _compute_topology(block_corners):
+    """ Computes the topology of a multiblock grid from its block corners.
+
+    Args:
+        block_corners: A (num_blocks, 4, 2) array of block corners, as returned
+            by get_corners for each block.
+
+    Returns:
+        corners: The unique corners.
+        faces: A (num_blocks, 4) array of corner indices for each block.
+        edges: An array of unique edges given as pairs of corner indices.
+        face_edges: A (num_blocks, 4) array of edge indices for each block,
+            where column k holds the edge of side _SIDES[k].
+    """
+    num_blocks = len(block_corners)
+    corners, inv = np.unique(block_corners.reshape(-1,2), axis=0,
+                             return_inverse=True)
+    faces = inv.reshape(num_blocks, 4)
+
+    # Each edge is encoded as a single integer key with the lower corner index
+    # in the high bits, so that sorting the keys orders the edges
+    # lexicographically by (lower, higher) corner index.
+    k = np.arange(4)
+    a = faces[:,k]
+    b = faces[:,(k+1)%4]
+    lo = np.minimum(a,b).astype(np.uint64)
+    hi = np.maximum(a,b).astype(np.uint64)
+    keys = (lo << np.uint64(32)) | hi
+    edge_keys, inv = np.unique(keys.ravel(), return_inverse=True)
+    edges = np.stack([edge_keys >> np.uint64(32),
+                      edge_keys & np.uint64(0xffffffff)],
+                     axis=1).astype(np.int64)
+    face_edges = inv.reshape(num_blocks, 4)
+
+    return corners, faces, edges, face_edges
+
+
+_TOPOLOGY_KEYS = ['corners', 'faces', 'edges', 'face_edges']
+
+
+def _load_topology(cache_file):
+    """ Loads a topology saved by _save_topology. Returns None if the file does
+    not exist or cannot be read. """
+    try:
+        with np.load(cache_file) as data:
+            return tuple(data[key] for key in _TOPOLOGY_KEYS)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def _save_topology(cache_file, topology):
+    """ Saves a topology as returned by _compute_topology to a file.
+
+    The topology is first written to a temporary file in the same directory,
+    which is then moved into place, so that an interrupted or concurrent write
+    never leaves a partially written cache file behind.
+    """
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz',
+                                     delete=False) as f:
+        tmp_file = f.name
+        try:
+            np.savez(f, **dict(zip(_TOPOLOGY_KEYS, topology)))
+        except BaseException:
+            f.close()
+            os.remove(tmp_file)
+            raise
+    os.replace(tmp_file, cache_file)
+
+
 class MultiblockGrid:
     """ Represents a structured multiblock grid.
 
     Attributes:
         num_blocks: The total number of blocks in the grid.
+        iface_src_block, iface_src_side, iface_dst_block, iface_dst_side:
+            Integer arrays describing the interfaces returned by
+            get_interfaces(). Sides are given as indices into ['s','e','n','w'].
+        iface_flip: Boolean array. True for flipped interfaces (see
+            is_flipped_interface).
     """
 
-    def __init__(self, blocks):
+    def __init__(self, blocks, cache_dir=None):
         """ Initializes a Multiblock object.
 
         Args:
@@ -127,96 +197,112 @@ class MultiblockGrid:
             Note that the structure of these blocks should be such that for the
             k:th element (X,Y) in the blocks list, we have that (X[i,j],Y[i,j])
             is the (i,j):th node in the k:th block.
+
+        Optional:
+            cache_dir: A directory (for example ~/.cache/sbpy) in which to cache
+                   the grid topology. The topology is stored in a file named by
+                   a hash of the block corners and is loaded from there if a
+                   grid with the same corners is created again.
         """
 
         for (X,Y) in blocks:
             assert(X.shape == Y.shape)
 
-        self.blocks = blocks
         self.num_blocks = len(blocks)
 
         self.shapes = []
         for (X,Y) in blocks:
             self.shapes.append((X.shape[0], X.shape[1]))
 
-        # Save unique corners
-        self.corners = []
-        for X,Y in self.blocks:
-            self.corners.append(get_corners(X,Y))
-
-        self.corners = np.unique(np.concatenate(self.corners), axis=0)
-
-        # Save faces in terms of unique corners
-        self.faces = []
-
-        for k,(X,Y) in enumerate(self.blocks):
-            block_corners = get_corners(X,Y)
-            indices = []
-            for c in block_corners:
-                idx = np.argwhere(np.all(c == self.corners, axis=1)).item()
-                indices.append(idx)
-            self.faces.append(np.array(indices))
-        self.faces = np.array(self.faces)
-
-        # Save unique edges
-        self.edges = []
-        for face in self.faces:
-            for k in range(4):
-                self.edges.append(np.array(sorted([face[k], face[(k+1)%4]])))
-
-        self.edges = np.unique(self.edges, axis=0)
-
-        # Save face edges
-        self.face_edges = []
-        for face in self.faces:
-            self.face_edges.append({})
-            for k,side in enumerate(_SIDES):
-                edge = np.array(sorted([face[k], face[(k+1)%4]]))
-                self.face_edges[-1][side] = \
-                    np.argwhere(np.all(edge == self.edges, axis=1)).item()
-
-        # Find interfaces
-        self.block_interfaces = [{} for _ in range(self.num_blocks)]
-        for ((i,edges1), (j,edges2)) in \
-        itertools.combinations(enumerate(self.face_edges),2):
-            for (side1,side2) in \
-            itertools.product(_SIDES, repeat=2):
-                if edges1[side1] == edges2[side2]:
-                    self.block_interfaces[i][side1] = (j, side2)
-                    self.block_interfaces[j][side2] = (i, side1)
+        # If all blocks have the same shape, store them in a single array of
+        # shape (num_blocks, 2, Nx, Ny), so that operations (for example
+        # function evaluations) can be carried out on all blocks at once. The
+        # blocks are then views into this array.
+        if len(set(self.shapes)) == 1:
+            self._XY = np.stack([ np.stack([X,Y]) for (X,Y) in blocks ])
+            self.blocks = [ (self._XY[k,0], self._XY[k,1]) for
+                            k in range(self.num_blocks) ]
+        else:
+            self._XY = None
+            self.blocks = blocks
+
+        # Save the corners of each block, the unique corners, faces and edges
+        # in terms of unique corners, and the edges of each face.
+        self.block_corners = np.stack([ get_corners(X,Y) for (X,Y) in blocks ])
+
+        topology = None
+        if cache_dir is not None:
+            key = hashlib.blake2b(self.block_corners.tobytes()).hexdigest()
+            cache_file = os.path.join(os.path.expanduser(cache_dir),
+                                      key + '.npz')
+            topology = _load_topology(cache_file)
+
+        if topology is None:
+            topology = _compute_topology(self.block_corners)
+            if cache_dir is not None:
+                _save_topology(cache_file, topology)
+
+        (self.corners, self.faces, self.edges, self.face_edges) = topology
+
+        # Find interfaces. Two sides make up an interface if they share an
+        # edge, i.e. if they are adjacent after sorting all sides by edge index.
+        slot_edges = self.face_edges.ravel()
+        order = np.argsort(slot_edges, kind='stable')
+        sorted_edges = slot_edges[order]
+        matches = np.flatnonzero(sorted_edges[:-1] == sorted_edges[1:])
+
+        # Save the interfaces as flat arrays, with sides given as indices into
+        # _SIDES. The k:th interface connects side iface_src_side[k] of block
+        # iface_src_block[k] to side iface_dst_side[k] of block
+        # iface_dst_block[k].
+        self.iface_src_block, self.iface_src_side = np.divmod(order[matches], 4)
+        self.iface_dst_block, self.iface_dst_side = np.divmod(order[matches+1], 4)
+        self.iface_flip = _IS_FLIPPED[self.iface_src_side, self.iface_dst_side]
 
+        self.block_interfaces = [{} for _ in range(self.num_blocks)]
         self.interfaces = []
-        for k in range(len(self.edges)):
-            blocks = []
-            sides = []
-            for n in range(self.num_blocks):
-                for side in _SIDES:
-                    if self.face_edges[n][side] == k:
-                        blocks.append(n)
-                        sides.append(side)
-            if len(blocks) == 2:
-                self.interfaces.append(((blocks[0],sides[0]),(blocks[1],sides[1])))
-
-        # Find external boundaries
-        self.boundaries = []
-        for block_idx in range(self.num_blocks):
-            for side in _SIDES:
-                if not self.is_interface(block_idx, side):
-                    self.boundaries.append((block_idx, side))
+        for (i,k1,j,k2) in zip(self.iface_src_block.tolist(),
+                               self.iface_src_side.tolist(),
+                               self.iface_dst_block.tolist(),
+                               self.iface_dst_side.tolist()):
+            side1,side2 = _SIDES[k1],_SIDES[k2]
+            self.block_interfaces[i][side1] = (j, side2)
+            self.block_interfaces[j][side2] = (i, side1)
+            self.interfaces.append(((i,side1),(j,side2)))
+
+        # Save, for each interface side, the neighbor block, the slice of the
+        # neighbor boundary and whether the neighbor data must be flipped.
+        self._neighbor_info = {}
+        for (block_idx, block_interfaces) in enumerate(self.block_interfaces):
+            for (side, (neighbor_idx, neighbor_side)) in block_interfaces.items():
+                self._neighbor_info[(block_idx, side)] = \
+                    (neighbor_idx, _BOUNDARY_SLICE[neighbor_side],
+                     (neighbor_side, side) in _FLIPPED_SIDE_PAIRS)
+
+        # Find external boundaries, i.e. sides whose edge belongs to no other
+        # side.
+        edge_counts = np.bincount(slot_edges, minlength=len(self.edges))
+        is_boundary = edge_counts[self.face_edges] == 1
+        self.boundaries = [ (int(block_idx), _SIDES[k]) for (block_idx,k) in
+                            zip(*np.nonzero(is_boundary)) ]
 
         self.num_boundaries = len(self.boundaries)
         self.boundary_info = [ None for _ in self.boundaries ]
 
-        # Save boundary slices
-        self.bd_slice_dicts = \
-                [{'s': (slice(Nx), 0),
-                 'e': (-1, slice(Ny)),
-                 'n': (slice(Nx), -1),
-                 'w': (0, slice(Ny))} for (Nx,Ny) in self.shapes]
 
+    def evaluate_function(self, f, vectorized_over_blocks=False):
+        """ Evaluates a (vectorized) function on the grid.
 
-    def evaluate_function(self, f):
-        """ Evaluates a (vectorized) function on the grid. """
+        Arguments:
+            f: A function f(X,Y) of the coordinates of a block.
+
+        Optional:
+            vectorized_over_blocks: If True and all blocks have the same shape,
+                f is called once with (num_blocks, Nx, Ny) arrays containing
+                all blocks. Only use this if f is elementwise.
+        """
+        if vectorized_over_blocks and self._XY is not None:
+            return list(f(self._XY[:,0], self._XY[:,1]))
         return [ f(X,Y) for (X,Y) in self.blocks ]
 
 
@@ -252,7 +338,7 @@ class MultiblockGrid:
         Returns:
             slice: A slice that can be used to index the given boundary in F.
         """
-        return self.bd_slice_dicts[k][side]
+        return _BOUNDARY_SLICE[side]
 
 
     def get_interfaces(self):
@@ -320,15 +406,8 @@ class MultiblockGrid:
         Returns:
             True if flipped, False otherwise.
         """
-        is_flipped = False
         ((_,side1),(_,side2)) = self.interfaces[interface_idx]
-        if (side1, side2) in [('s','e'), ('s','s'),
-                              ('e','s'), ('e','e'),
-                              ('n','w'), ('n','n'),
-                              ('w','n'), ('w','w')]:
-            is_flipped = True
-
-        return is_flipped
+        return (side1, side2) in _FLIPPED_SIDE_PAIRS
 
 
     def plot_grid(self):
@@ -336,12 +415,19 @@ class MultiblockGrid:
 
         fig, ax = plt.subplots()
         for X,Y in self.blocks:
-            ax.plot(X,Y,'b')
-            ax.plot(np.transpose(X),np.transpose(Y),'b')
-            for side in {'w', 'e', 's', 'n'}:
+            # Only interior gridlines, the outer ones are drawn as boundaries.
+            ax.plot(X[:,1:-1],Y[:,1:-1],'b')
+            ax.plot(X[1:-1,:].T,Y[1:-1,:].T,'b')
+
+            # Draw all four boundaries as one line, separated by NaNs.
+            x_bd = []
+            y_bd = []
+            for side in _SIDES:
                 x,y = get_boundary(X,Y,side)
-                ax.plot(x,y,'k',linewidth=3)
+                x_bd.extend([x, [np.nan]])
+                y_bd.extend([y, [np.nan]])
                 ax.text(np.mean(x),np.mean(y),side)
+            ax.plot(np.concatenate(x_bd),np.concatenate(y_bd),'k',linewidth=3)
 
         ax.axis('equal')
         plt.show()
@@ -353,6 +439,7 @@ class MultiblockGrid:
         Arguments:
             boundary_indices: True or False. Draws indices at the boundaries.
             interface_indices: True or False. Draws indices at the interfaces.
+            use_tex: True or False. Renders text using LaTeX.
         """
 
         interface_indices = False
@@ -367,49 +454,56 @@ class MultiblockGrid:
         else:
             interface_indices = False
 
-
-        fig, ax = plt.subplots()
-        for k,(X,Y) in enumerate(self.blocks):
-            xs,ys = get_boundary(X,Y,'s')
-            xe,ye = get_boundary(X,Y,'e')
-            xn,yn = get_boundary(X,Y,'n')
-            xn = np.flip(xn)
-            yn = np.flip(yn)
-            xw,yw = get_boundary(X,Y,'w')
-            xw = np.flip(xw)
-            yw = np.flip(yw)
-            x_poly = np.concatenate([xs,xe,xn,xw])
-            y_poly = np.concatenate([ys,ye,yn,yw])
-
-            ax.fill(x_poly,y_poly,'tab:gray')
-            ax.plot(x_poly,y_poly,'k')
-            c = get_center(X,Y)
-            ax.text(c[0], c[1], "$\Omega_" + str(k) + "$", fontsize=20,
-                    fontweight='bold')
-
-        # Draw boundary indices
-        if boundary_indices:
-            for (bd_idx, (block_idx, side)) in enumerate(self.boundaries):
-                X,Y = self.blocks[block_idx]
-                xb,yb = get_boundary(X,Y,side)
-                xc = np.median(xb)
-                yc = np.median(yb)
-                ax.text(xc, yc, str(bd_idx), fontsize=20,
-                        fontweight='bold')
-
-        # Draw interface indices
-        if interface_indices:
-            for (if_idx, interface) in enumerate(self.interfaces):
-                (blk_idx,side),(_,_) = interface
-                X,Y = self.blocks[blk_idx]
-                xb,yb = get_boundary(X,Y,side)
-                xc = np.median(xb)
-                yc = np.median(yb)
-                ax.text(xc, yc, str(if_idx), fontsize=20,
+        if 'use_tex' in kwargs:
+            use_tex = kwargs['use_tex']
+        else:
+            use_tex = False
+
+        # Only enable LaTeX for this plot, without changing global settings.
+        with rc_context({'text.usetex': use_tex}):
+            fig, ax = plt.subplots()
+            polys = []
+            for (X,Y) in self.blocks:
+                xs,ys = get_boundary(X,Y,'s')
+                xe,ye = get_boundary(X,Y,'e')
+                xn,yn = get_boundary(X,Y,'n')
+                xw,yw = get_boundary(X,Y,'w')
+                x_poly = np.concatenate([xs,xe,np.flip(xn),np.flip(xw)])
+                y_poly = np.concatenate([ys,ye,np.flip(yn),np.flip(yw)])
+                polys.append(np.column_stack([x_poly,y_poly]))
+
+            ax.add_collection(PolyCollection(polys, facecolors='tab:gray',
+                                             edgecolors='k'))
+            ax.autoscale_view()
+
+            centers = np.mean(self.block_corners, axis=1)
+            for k,c in enumerate(centers):
+                ax.text(c[0], c[1], "$\Omega_" + str(k) + "$", fontsize=20,
                         fontweight='bold')
 
-        ax.axis('equal')
-        plt.show()
+            # Draw boundary indices
+            if boundary_indices:
+                for (bd_idx, (block_idx, side)) in enumerate(self.boundaries):
+                    X,Y = self.blocks[block_idx]
+                    xb,yb = get_boundary(X,Y,side)
+                    xc = np.median(xb)
+                    yc = np.median(yb)
+                    ax.text(xc, yc, str(bd_idx), fontsize=20,
+                            fontweight='bold')
+
+            # Draw interface indices
+            if interface_indices:
+                for (if_idx, interface) in enumerate(self.interfaces):
+                    (blk_idx,side),(_,_) = interface
+                    X,Y = self.blocks[blk_idx]
+                    xb,yb = get_boundary(X,Y,side)
+                    xc = np.median(xb)
+                    yc = np.median(yb)
+                    ax.text(xc, yc, str(if_idx), fontsize=20,
+                            fontweight='bold')
+
+            ax.axis('equal')
+            plt.show()
 
 
     def get_neighbor_boundary(self, F, block_idx, side):
@@ -420,21 +514,11 @@ class MultiblockGrid:
             block_idx: The index of the block to send data to.
             side: The side of the block to send data to ('s', 'e', 'n', or 'w').
         """
-        assert(self.is_interface(block_idx, side))
-
-        neighbor_idx, neighbor_side = self.block_interfaces[block_idx][side]
-
-        flip = False
-        if (neighbor_side, side) in [('s','e'), ('s','s'),
-                                     ('e','s'), ('e','e'),
-                                     ('n','w'), ('n','n'),
-                                     ('w','n'), ('w','w')]:
-            flip = True
-
+        _, bd_slice, flip = self._neighbor_info[(block_idx, side)]
         if flip:
-            return np.flip(get_function_boundary(F, neighbor_side))
+            return F[bd_slice][::-1]
         else:
-            return get_function_boundary(F, neighbor_side)
+            return F[bd_slice]
 
 
     def set_boundary_info(self, boundary_index, info):
@@ -527,8 +611,6 @@ def load_p3d(filename):
     with open(filename) as data:
         num_blocks = int(data.readline())
 
-        X = []
-        Y = []
         Nx = []
         Ny = []
         for _ in range(num_blocks):
@@ -536,22 +618,15 @@ def load_p3d(filename):
             Nx.append(size[0])
             Ny.append(size[1])
 
+        # Each block is stored as Nx rows of x-values, Nx rows of y-values and
+        # Nx rows of z-values, where each row holds Ny values.
         blocks = []
         for k in range(num_blocks):
-            X_cur = []
-            Y_cur = []
-            for n in range(Nx[k]):
-                X_cur.append(np.fromstring(data.readline(), sep=' '))
-            for n in range(Nx[k]):
-                Y_cur.append(np.fromstring(data.readline(), sep=' '))
-
-            blocks.append((np.array(X_cur),np.array(Y_cur)))
-            #X.append(np.array(X_cur))
-            #Y.append(np.array(Y_cur))
+            block_data = np.loadtxt(data, max_rows=2*Nx[k], ndmin=2)
+            blocks.append((block_data[:Nx[k]], block_data[Nx[k]:]))
             for _ in range(Nx[k]):
                 next(data)
 
-
     return blocks
 
 
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from sbpy.utils import get_annulus_grid
+from sbpy.grid2d import MultiblockGrid, load_p3d
+
+
+def get_rotated_grid():
+    """ Returns two unit square blocks sharing an east-to-east interface. """
+    X0,Y0 = np.meshgrid(np.linspace(0,1,4), np.linspace(0,1,4), indexing='ij')
+    X1,Y1 = np.meshgrid(np.linspace(1,2,4), np.linspace(0,1,4), indexing='ij')
+    return [(X0,Y0), (X1[::-1,::-1].copy(), Y1[::-1,::-1].copy())]
+
+
+class TestGrid2d(unittest.TestCase):
+
+    grid = MultiblockGrid(get_annulus_grid(6))
+
+
+    def test_annulus_interfaces(self):
+        self.assertEqual(self.grid.get_interfaces(),
+                         [((1,'n'),(2,'s')), ((2,'n'),(3,'s')),
+                          ((0,'n'),(1,'s')), ((0,'s'),(3,'n'))])
+        self.assertEqual(self.grid.get_block_interfaces(),
+                         [{'n': (1,'s'), 's': (3,'n')},
+                          {'s': (0,'n'), 'n': (2,'s')},
+                          {'s': (1,'n'), 'n': (3,'s')},
+                          {'n': (0,'s'), 's': (2,'n')}])
+
+
+    def test_annulus_boundaries(self):
+        self.assertEqual(self.grid.get_boundaries(),
+                         [(0,'e'), (0,'w'), (1,'e'), (1,'w'),
+                          (2,'e'), (2,'w'), (3,'e'), (3,'w')])
+
+
+    def test_flipped_interfaces(self):
+        for grid in [self.grid, MultiblockGrid(get_rotated_grid())]:
+            for k in range(len(grid.get_interfaces())):
+                self.assertEqual(grid.iface_flip[k],
+                                 grid.is_flipped_interface(k))
+
+        self.assertEqual([ self.grid.is_flipped_interface(k) for k in range(4) ],
+                         [False]*4)
+
+        grid = MultiblockGrid(get_rotated_grid())
+        self.assertEqual(grid.get_interfaces(), [((0,'e'),(1,'e'))])
+        self.assertTrue(grid.is_flipped_interface(0))
+
+
+    def test_neighbor_boundary(self):
+        for grid in [self.grid, MultiblockGrid(get_rotated_grid())]:
+            F = grid.evaluate_function(lambda x,y: x + 10*y)
+            for ((i,side1),(j,side2)) in grid.get_interfaces():
+                x,y = grid.get_boundary(i, side1)
+                f = grid.get_neighbor_boundary(F[j], i, side1)
+                self.assertTrue(np.allclose(f, x + 10*y))
+
+
+    def test_topology_cache(self):
+        blocks = get_annulus_grid(6)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            MultiblockGrid(blocks, cache_dir=cache_dir)
+            (cache_file,) = os.listdir(cache_dir)
+            with open(os.path.join(cache_dir, cache_file), 'wb') as f:
+                f.write(b'truncated')
+
+            grid = MultiblockGrid(blocks, cache_dir=cache_dir)
+            self.assertEqual(grid.get_interfaces(), self.grid.get_interfaces())
+
+            grid = MultiblockGrid(blocks, cache_dir=cache_dir)
+            self.assertEqual(grid.get_interfaces(), self.grid.get_interfaces())
+
+
+    def test_load_p3d(self):
+        blocks = [(np.arange(12.0).reshape(3,4), -np.arange(12.0).reshape(3,4)),
+                  (np.arange(10.0).reshape(5,2) + 0.5, np.ones((5,2)))]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'grid.p3d')
+            with open(filename, 'w') as f:
+                f.write("{}\n".format(len(blocks)))
+                for (X,Y) in blocks:
+                    f.write("{} {} 1\n".format(*X.shape))
+                for (X,Y) in blocks:
+                    for A in [X, Y, np.zeros(X.shape)]:
+                        np.savetxt(f, A)
+
+            loaded = load_p3d(filename)
+
+        self.assertEqual(len(loaded), len(blocks))
+        for ((X,Y),(X_loaded,Y_loaded)) in zip(blocks, loaded):
+            self.assertTrue(np.array_equal(X, X_loaded))
+            self.assertTrue(np.array_equal(Y, Y_loaded))
+
+
+if __name__ == '__main__':
+    unittest.main()